@@ -1,16 +1,26 @@
 import os
 import json
+from zoneinfo import ZoneInfo
+
 import requests
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; stdlib json also accepts bytes
+    orjson = None
+
 
 # --- Configuration ---
-LOGIN_URL = "https://login.aimharder.com/"
 TIMEZONE = "Europe/Madrid"
+TZ = ZoneInfo(TIMEZONE)
 
 # Default box configuration — read from environment 
 DEFAULT_BOX_NAME = os.environ.get("BOX_NAME", "")
 DEFAULT_BOX_ID = int(os.environ.get("BOX_ID", 0))
 
+# Parses raw bytes (e.g. response.content) without decoding them to str first
+json_loads = orjson.loads if orjson else json.loads
+
 
 
 def send_telegram_notification(message: str) -> bool:
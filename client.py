@@ -1,21 +1,33 @@
 import hashlib
+import time
 from datetime import datetime
 from typing import Union
 
 from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bot_utils import json_loads
 
 LOGIN_URL = "https://aimharder.com/api/login"
+# Keys the bookings endpoint has used for the class list, in lookup order
+_CLASS_KEYS = ("bookings", "classes")
+# Longest Retry-After (seconds) we are willing to wait before resending a rate-limited request
+MAX_RETRY_AFTER = 5
+# (connect, read) timeout for the pre-target warm-up, which is never retried
+WARMUP_TIMEOUT = (1, 1)
 
 
 class AimHarderClient:
     def __init__(self, email: str, password: str, box_name: str, box_id: int):
         self.box_name = box_name
         self.box_id = box_id
+        # Endpoints are fixed per box, so build them once instead of per request
+        self._base_url = f"https://{box_name}.aimharder.com"
+        self._bookings_url = f"{self._base_url}/api/bookings"
+        self._book_url = f"{self._base_url}/api/book"
         self.session = self._login(email, password)
 
-    def _base_url(self) -> str:
-        return f"https://{self.box_name}.aimharder.com"
-
     def _date_str(self, date: datetime) -> str:
         return date.strftime("%Y%m%d")
 
@@ -24,6 +36,22 @@ class AimHarderClient:
 
     def _login(self, email: str, password: str) -> Session:
         session = Session()
+        # One keep-alive pool for the whole run: login, class listing and the
+        # booking POST reuse the same TLS connection instead of reconnecting.
+        # Retry (with a short exponential backoff) only covers idempotent methods,
+        # so a POST is never replayed. Retry-After is ignored here: urllib3 would
+        # honour arbitrarily long values; 429s are handled, capped, in _request().
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=10,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[502, 503, 504],
+                respect_retry_after_header=False,
+            ),
+        )
+        session.mount("https://", adapter)
         session.headers.update({
             "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
             # ⚠️ NO ponemos Content-Type aquí — cada request lo gestiona solo
@@ -46,33 +74,54 @@ class AimHarderClient:
         print("Logged successfully")
         return session
 
+    def _request(self, method: str, url: str, **kwargs):
+        resp = self.session.request(method, url, **kwargs)
+        # A 429 was not processed, so resending once after a short Retry-After is safe
+        # (and cannot double-book); longer waits would cost the booking window anyway
+        retry_after = resp.headers.get("Retry-After", "")
+        if resp.status_code == 429 and retry_after.isdigit() and int(retry_after) <= MAX_RETRY_AFTER:
+            time.sleep(int(retry_after))
+            resp = self.session.request(method, url, **kwargs)
+        return resp
+
     def list_classes(self, date: datetime) -> list[dict]:
-        url = f"{self._base_url()}/api/bookings"
-        resp = self.session.get(url, params={"box": self.box_id, "day": self._date_str(date)})
+        resp = self._request("GET", self._bookings_url, params={"box": self.box_id, "day": self._date_str(date)})
         resp.raise_for_status()
-        data = resp.json()
+        data = json_loads(resp.content)
         if isinstance(data, list):
             return data
         if isinstance(data, dict):
-            return data.get("bookings", data.get("classes", []))
+            return next((data[k] for k in _CLASS_KEYS if k in data), [])
         return []
 
     def book_class(self, class_id: Union[int, str], date: datetime, insist: int = 0) -> dict:
-        url = f"{self._base_url()}/api/book"
-        resp = self.session.post(
-            url,
-            data={"id": str(class_id), "day": self._date_str(date), "insist": insist},
-            # data= pone automáticamente Content-Type: application/x-www-form-urlencoded
-        )
+        payload = {"id": str(class_id), "day": self._date_str(date), "insist": insist}
+        # data= pone automáticamente Content-Type: application/x-www-form-urlencoded
+        resp = self._request("POST", self._book_url, data=payload)
         resp.raise_for_status()
         try:
-            return resp.json()
+            return json_loads(resp.content)
         except Exception:
-            return {"raw": resp.text}
+            # Only the head of a non-JSON body (e.g. an HTML error page) is useful for logs
+            return {"raw": resp.content[:500].decode("utf-8", errors="replace")}
+
+    def warmup(self):
+        # Best-effort: opens a keep-alive connection so the next request skips the handshake.
+        # The session's retries are switched off for this call (same adapter, so the same
+        # pool) so a slow or rate-limited box cannot hold us past the booking window.
+        adapter = self.session.get_adapter(self._base_url)
+        retries = adapter.max_retries
+        adapter.max_retries = Retry(0, read=False)
+        try:
+            self.session.head(self._base_url, timeout=WARMUP_TIMEOUT)
+        except Exception:
+            pass
+        finally:
+            adapter.max_retries = retries
 
     def logout(self):
         try:
-            self.session.get(f"{self._base_url()}/logout", allow_redirects=True, timeout=10)
+            self.session.get(f"{self._base_url}/logout", allow_redirects=True, timeout=10)
         except Exception:
             pass
         self.session.cookies.clear()
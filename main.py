@@ -7,34 +7,46 @@ Automatically books classes based on a predefined schedule.
 import argparse
 import json
 import os
+import re
 import sys
 import time
 from datetime import datetime, timedelta
-from typing import Optional
-
-import pytz
-import requests
+from typing import Callable, Optional
 
 # Import shared utilities
 from bot_utils import (
-    send_telegram_notification,
-    TIMEZONE, DEFAULT_BOX_NAME, DEFAULT_BOX_ID
+    send_telegram_notification, json_loads,
+    TZ, DEFAULT_BOX_NAME, DEFAULT_BOX_ID
 )
-from client import AimHarderClient
+from client import AimHarderClient, WARMUP_TIMEOUT
+
+# Warm up as late as the bounded warm-up request allows: it must finish well
+# before the target, but the socket should not sit idle long enough for the
+# server's keep-alive timeout to close it
+_WARMUP_MIN_LEAD = sum(WARMUP_TIMEOUT) + 1
+# Seconds before the target at which the --prefetch class lookup runs
+_PREFETCH_LEAD = 60
+
+# Spanish day names indexed by datetime.weekday() (Monday == 0)
+_DAYS_ES = ("Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo")
 
 
-def wait_until_target_time(target_hour: int, target_minute: int, skip_wait: bool = False) -> None:
+def wait_until_target_time(target_hour: int, target_minute: int, skip_wait: bool = False,
+                           client: Optional[AimHarderClient] = None,
+                           prefetch: Optional[Callable[[], bool]] = None) -> bool:
     """
     Wait until the target booking time (e.g. 12:00 Madrid).
     Handles both winter (UTC+1) and summer (UTC+2) automatically.
     Sleeps 1s past the target so the booking window is guaranteed to be open.
+    If a client is given, its connection is warmed up about 3-4s before the target.
+    If prefetch is given, it is called once about a minute before the target; when it
+    returns False the wait is abandoned and False is returned.
     """
     if skip_wait:
         print("⏩ Skipping wait (--skip-wait flag set)")
-        return
+        return True
 
-    tz = pytz.timezone(TIMEZONE)
-    now = datetime.now(tz)
+    now = datetime.now(TZ)
 
     # Create target time for today
     target = now.replace(hour=target_hour, minute=target_minute, second=0, microsecond=0)
@@ -42,43 +54,88 @@ def wait_until_target_time(target_hour: int, target_minute: int, skip_wait: bool
     # If we're past target time, no need to wait
     if now >= target:
         print(f"⏰ Current time ({now.strftime('%H:%M:%S')}) is past target ({target.strftime('%H:%M')}). Proceeding immediately.")
-        return
+        return True
 
     wait_seconds = (target - now).total_seconds()
     print(f"⏳ Current Madrid time: {now.strftime('%H:%M:%S')}")
     print(f"⏳ Target time: {target.strftime('%H:%M:%S')}")
     print(f"⏳ Waiting {wait_seconds:.0f} seconds ({wait_seconds/60:.1f} minutes)...")
 
-    # Wait in chunks to show progress
+    # Sleep long while far from the target and poll finely as it approaches,
+    # so we never overshoot the booking window by more than a few ms.
+    target_ts = target.timestamp()
+    warmed_up = False
+    prefetched = False
+    last_log = time.monotonic()
     while True:
-        now = datetime.now(tz)
-        remaining = (target - now).total_seconds()
+        remaining = target_ts - time.time()
+
+        if prefetch is not None and not prefetched and remaining <= _PREFETCH_LEAD:
+            prefetched = True
+            if not prefetch():
+                return False
+            continue
+
+        # The login connection has likely gone idle during a long wait
+        if client is not None and not warmed_up and _WARMUP_MIN_LEAD < remaining <= _WARMUP_MIN_LEAD + 1:
+            client.warmup()
+            warmed_up = True
+            continue
 
         if remaining <= 0:
             # Sleep 1s past the target so the booking window is open
             time.sleep(1)
             print("✅ Target time reached! Proceeding with booking...")
-            break
-
-        # Sleep for min(30 seconds, remaining time)
-        sleep_time = min(30, remaining)
-        time.sleep(sleep_time)
+            return True
 
-        if remaining > 30:
+        if remaining > 300:
+            sleep_time = 60
+        elif remaining > 30:
+            sleep_time = 10
+        elif remaining > 2:
+            sleep_time = 0.5
+        else:
+            # One sleep to just short of the target, then spin out the last few ms
+            time.sleep(max(remaining - 0.05, 0))
+            while time.time() < target_ts:
+                pass
+            continue
+        time.sleep(min(sleep_time, remaining))
+
+        # Progress at most once a minute, quiet for the final 30s
+        if remaining > 30 and time.monotonic() - last_log >= 60:
             print(f"   ⏳ {remaining:.0f}s remaining...")
+            last_log = time.monotonic()
 
 
 
 
 def load_schedule(path: str = "schedule.json") -> dict:
     """Load the weekly schedule from JSON file."""
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(path, "rb") as f:
+        return json_loads(f.read())
+
 
+# Common field names used by the API for the same value, in lookup order
+_TIME_KEYS = ("timeid", "time", "startTime")
+_NAME_KEYS = ("className", "name", "activity")
+_BOOKED_KEYS = ("booked", "isBooked", "reservada")
+# API "HHMM_duration" time, e.g. "0700_60"
+_DISPLAY_TIME_RE = re.compile(r"(\d{2})(\d{2})_")
 
 
+def _first(d: dict, keys: tuple, default=None):
+    """Return the value of the first key in `keys` present (and not None) in `d`."""
+    for k in keys:
+        v = d.get(k)
+        if v is not None:
+            return v
+    return default
 
 
+def _normalize_time(value) -> str:
+    """Normalize API time formats to "HHMM": "0700_60" -> "0700", "07:00:00" -> "0700"."""
+    return str(value).partition("_")[0].replace(":", "")[:4]
 
 
 def find_matching_class(classes: list, target_time: str, target_name: str) -> Optional[dict]:
@@ -87,33 +144,17 @@ def find_matching_class(classes: list, target_time: str, target_name: str) -> Op
     """
     # Normalize target time: "19:00" -> "1900"
     target_time_normalized = target_time.replace(":", "")
+    target_name_lower = target_name.lower()
     
     for cls in classes:
-        # Common field names for time
-        class_time = cls.get("timeid", cls.get("time", cls.get("startTime", "")))
-        # Common field names for class name
-        class_name = cls.get("className", cls.get("name", cls.get("activity", "")))
-        
-        # Normalize API time format: "0700_60" -> "0700", "07:00" -> "0700"
-        if isinstance(class_time, str):
-            # Handle "0700_60" format (time_duration)
-            if "_" in class_time:
-                class_time_normalized = class_time.split("_")[0]
-            else:
-                # Handle "07:00" or "07:00:00" format
-                class_time_normalized = class_time.replace(":", "")[:4]
-        else:
-            class_time_normalized = str(class_time)
+        class_time = _first(cls, _TIME_KEYS, "")
+        class_name = _first(cls, _NAME_KEYS, "")
         
-        time_match = class_time_normalized == target_time_normalized
-        name_match = target_name.lower() in class_name.lower()
-        
-        if time_match and name_match:
+        if _normalize_time(class_time) == target_time_normalized and target_name_lower in class_name.lower():
             print(f"✅ Found matching class: {class_name} at {class_time}")
             
             # Check if already booked
-            is_booked = cls.get("booked") or cls.get("isBooked") or cls.get("reservada")
-            if is_booked:
+            if any(cls.get(k) for k in _BOOKED_KEYS):
                 print(f"⚠️ Class '{class_name}' at {class_time} appears to be ALREADY BOOKED.")
                 cls["_is_already_booked"] = True # Mark for caller
             
@@ -125,6 +166,27 @@ def find_matching_class(classes: list, target_time: str, target_name: str) -> Op
 
 
 
+def fetch_matching_class(client: AimHarderClient, target_date: datetime, target_time: str, target_name: str) -> Optional[dict]:
+    """
+    List the classes for target_date and return the one matching the target time and name.
+    Prints why and returns None if the listing fails or nothing matches.
+    """
+    try:
+        classes = client.list_classes(target_date)
+    except Exception as e:
+        print(f"❌ Error fetching classes: {e}")
+        return None
+
+    if not classes:
+        print(f"❌ No classes found for {target_date.strftime('%Y-%m-%d')}")
+        return None
+
+    matching_class = find_matching_class(classes, target_time, target_name)
+    if not matching_class:
+        print(f"❌ No matching class found for {target_name} at {target_time}")
+    return matching_class
+
+
 def print_and_notify_booking(box_name: str, class_name: str, display_time: str, full_date_str: str, status: str, err: str = ""):
     if status == "CONFIRMED":
         print(f"✅ Successfully booked '{class_name}' at {display_time} on {full_date_str}")
@@ -156,24 +218,28 @@ def print_and_notify_booking(box_name: str, class_name: str, display_time: str,
         )
     send_telegram_notification(msg)
 
-def process_booking(client: AimHarderClient, class_info: dict, target_date: datetime, dry_run: bool = False) -> bool:
-    class_id = class_info.get("id", class_info.get("classId", class_info.get("sessionId")))
-    class_name = class_info.get("className", class_info.get("name", "Unknown"))
+def process_booking(client: AimHarderClient, class_info: dict, target_date: datetime, dry_run: bool = False,
+                    refetch: Optional[Callable[[], Optional[dict]]] = None) -> bool:
+    """
+    Book class_info and notify the outcome.
+    If refetch is given (class_info came from a prefetch), a failed booking looks the
+    class up again with it and retries once before reporting the failure.
+    """
+    class_id = _first(class_info, ("id", "classId", "sessionId"))
+    class_name = _first(class_info, ("className", "name"), "Unknown")
     if not class_id:
         print("❌ Could not determine class ID from class info")
         return False
         
-    display_time = class_info.get("time", class_info.get("startTime", "Unknown"))
-    if isinstance(display_time, str) and "_" in display_time:
-        display_time = display_time.split("_")[0]
-        if len(display_time) == 4 and display_time.isdigit():
-            display_time = f"{display_time[:2]}:{display_time[2:]}"
+    display_time = _first(class_info, ("time", "startTime"), "Unknown")
+    # "0700_60" -> "07:00"; any other "<time>_<duration>" just loses the duration suffix
+    m = _DISPLAY_TIME_RE.match(str(display_time))
+    if m:
+        display_time = f"{m[1]}:{m[2]}"
+    elif isinstance(display_time, str):
+        display_time = display_time.partition("_")[0]
             
-    days_es = {
-        "Monday": "Lunes", "Tuesday": "Martes", "Wednesday": "Miércoles",
-        "Thursday": "Jueves", "Friday": "Viernes", "Saturday": "Sábado", "Sunday": "Domingo"
-    }
-    day_name = days_es.get(target_date.strftime("%A"), target_date.strftime("%A"))
+    day_name = _DAYS_ES[target_date.weekday()]
     full_date_str = f"{day_name} {target_date.strftime('%d/%m/%Y')}"
 
     if dry_run:
@@ -187,13 +253,22 @@ def process_booking(client: AimHarderClient, class_info: dict, target_date: date
         if book_state == 1:
             print_and_notify_booking(client.box_name, class_name, display_time, full_date_str, "CONFIRMED")
             return True
-        else:
-            reason = resp.get("errorMssg", resp.get("bookError", resp.get("error", ""))) or f"bookState={book_state}"
-            print_and_notify_booking(client.box_name, class_name, display_time, full_date_str, "FAILED", reason)
-            return False
+        reason = _first(resp, ("errorMssg", "bookError", "error"), "") or f"bookState={book_state}"
     except Exception as e:
-        print_and_notify_booking(client.box_name, class_name, display_time, full_date_str, "FAILED", str(e))
-        return False
+        reason = str(e)
+
+    if refetch is not None:
+        # The prefetched class may be stale (or the window not open yet, bookState -12)
+        print(f"🔁 Booking the prefetched class failed ({reason}). Looking it up again...")
+        fresh = refetch()
+        if fresh and fresh.get("_is_already_booked"):
+            print(f"ℹ️ Skipping booking: Already booked.")
+            return True
+        if fresh:
+            return process_booking(client, fresh, target_date, dry_run=dry_run)
+
+    print_and_notify_booking(client.box_name, class_name, display_time, full_date_str, "FAILED", reason)
+    return False
 
 
 
@@ -212,6 +287,7 @@ def main():
     _default_hour = int(os.environ.get("TARGET_HOUR_GMT1", os.environ.get("TARGET_HOUR", 12)))
     parser.add_argument("--target-hour", type=int, default=_default_hour, help="Target hour in Madrid time (0-23) to trigger booking, default: 12")
     parser.add_argument("--target-minute", type=int, default=int(os.environ.get("TARGET_MINUTE", 0)), help="Target minute to run (0-59), default: 0")
+    parser.add_argument("--prefetch", action="store_true", help="Look up the target class about a minute before target time so only the booking request runs at target time")
     parser.add_argument("--update-status", action="store_true", help="Just update the booking status JSON and exit")
     args = parser.parse_args()
     
@@ -241,6 +317,21 @@ def main():
     box_name = args.box_name or env_box_name or box.get("name") or DEFAULT_BOX_NAME
     box_id = int(box_id_val) if box_id_val else 0
 
+    # Determine target date
+    now = datetime.now(TZ)
+    target_date = now + timedelta(days=args.days_ahead)
+    day_name = target_date.strftime("%A")
+
+    print(f"📅 Target date: {target_date.strftime('%Y-%m-%d')} ({day_name})")
+
+    # Resolve the day's target before logging in, so an empty day exits without touching the network
+    day_schedule = box.get(day_name)
+    print(f"📅 day_schedule:" ,day_schedule)
+
+    if not day_schedule and not args.update_status:
+        print(f"ℹ️ No classes scheduled for {day_name}.")
+        return
+
     try:
         client = AimHarderClient(email, password, box_name, box_id)
     except Exception as e:
@@ -251,49 +342,39 @@ def main():
         # Assuming update_booking_status was defined somewhere or ignored
         # update_booking_status(client.session, box, box_name, box_id)
         return
-    
-    # Determine target date
-    tz = pytz.timezone(TIMEZONE)
-    now = datetime.now(tz)
-    target_date = now + timedelta(days=args.days_ahead)
-    day_name = target_date.strftime("%A")
-    
-    print(f"📅 Target date: {target_date.strftime('%Y-%m-%d')} ({day_name})")
-    
-    # Check if we should wait
-    day_schedule = box.get(day_name)
-    print(f"📅 day_schedule:" ,day_schedule)
 
+    target_time = day_schedule.get("time")
+    target_class = day_schedule.get("class_name")
 
-    if day_schedule:
-        wait_until_target_time(args.target_hour, args.target_minute, skip_wait=args.skip_wait)
-    else:
-        print(f"ℹ️ No classes scheduled for {day_name}.")
+    # With --prefetch, the class is looked up about a minute before the window opens,
+    # so only the booking POST is left at target time
+    matching_class = None
+
+    def prefetch() -> bool:
+        nonlocal matching_class
+        print(f"🔎 Prefetching classes for {target_date.strftime('%Y-%m-%d')}...")
+        matching_class = fetch_matching_class(client, target_date, target_time, target_class)
+        if not matching_class:
+            print("⚠️ Prefetch found no matching class. Will fetch again after the wait.")
+            return True
+        # Nothing left to wait for if the class is already ours
+        return not matching_class.get("_is_already_booked")
+
+    if not wait_until_target_time(args.target_hour, args.target_minute, skip_wait=args.skip_wait,
+                                  client=client, prefetch=prefetch if args.prefetch else None):
+        print(f"ℹ️ Skipping booking: Already booked.")
         return
 
     # Process booking
     print(f"\n🚀 Processing Box: {box_name} (ID: {box_id})")
     
-    target_time = day_schedule.get("time")
-    target_class = day_schedule.get("class_name")
-    
     print(f"🎯 Target: {target_class} at {target_time}")
     
-    try:
-        classes = client.list_classes(target_date)
-    except Exception as e:
-        print(f"❌ Error fetching classes: {e}")
-        classes = []
-        
-    if not classes:
-        print(f"❌ No classes found for {target_date.strftime('%Y-%m-%d')}")
-        sys.exit(1)
-        
-    # Find matching class
-    matching_class = find_matching_class(classes, target_time, target_class)
-    if not matching_class:
-        print(f"❌ No matching class found for {target_class} at {target_time}")
-        sys.exit(1)
+    prefetched = matching_class is not None
+    if not prefetched:
+        matching_class = fetch_matching_class(client, target_date, target_time, target_class)
+        if not matching_class:
+            sys.exit(1)
         
     # Check if already booked
     if matching_class.get("_is_already_booked"):
@@ -302,7 +383,8 @@ def main():
         
 
     # Book the class
-    success = process_booking(client, matching_class, target_date, dry_run=args.dry_run)
+    refetch = (lambda: fetch_matching_class(client, target_date, target_time, target_class)) if prefetched else None
+    success = process_booking(client, matching_class, target_date, dry_run=args.dry_run, refetch=refetch)
 
     if success:
         print("\n🏁 Booking completed successfully.")